@@ -20,6 +20,7 @@
 
 import os
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
 import pandas as pd
@@ -30,15 +31,18 @@ from matplotlib.gridspec import GridSpec
 from matplotlib.animation import FuncAnimation
 
 from sklearn.decomposition import PCA
-from sklearn.preprocessing import MinMaxScaler
 from sklearn.model_selection import train_test_split
 from skimage.util import random_noise
 from skimage.transform import resize
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range #numba is optional; apply_noise falls back to skimage
 
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 import keras.backend as K
-from keras import Model, regularizers
+from keras import Model, regularizers, mixed_precision
 from keras.layers import *
 #from keras_cv.layers import *
 from keras.optimizers import SGD, Adam, Nadam, AdamW
@@ -49,8 +53,11 @@ from keras.callbacks import LearningRateScheduler, ReduceLROnPlateau
 class SpatiotemporalCO2:
     def __init__(self):
         K.clear_session()
+        mixed_precision.set_global_policy('mixed_float16')
         self.input_features_dir = 'simulations2D/input_features'
         self.output_targets_dir = 'simulations2D/output_targets'
+        self.x_all_file         = 'simulations2D/X_all.npy'
+        self.y_all_file         = 'simulations2D/y_all.npy'
         self.x_data_labels = ['Poro', 'LogPerm', 'Facies',  'Wells']
         self.y_data_labels = ['Pressure', 'Saturation']
         self.x_cmaps       = ['jet', 'jet', 'viridis', 'binary']
@@ -59,13 +66,17 @@ class SpatiotemporalCO2:
         self.latent_cmap   = ['afmhot_r', 'gray']
         self.return_data   = False
         self.save_model    = True
+        self.tflite_file   = 'CNN_RNN_Proxy.tflite'
 
         self.n_samples   = 1000
+        self.n_workers   = os.cpu_count()
         self.x_channels  = 4
         self.y_channels  = 2
         self.timesteps   = 60
         self.dim         = 64
         self.test_size   = 0.25
+        self.augment     = True
+        self.rotations   = 3
         self.t_samples   = [0, 6, 12, 18, 24, 30, 36, 42, 48, 54, 60]
         
         self.cnn_filters = [64,  128, 256]
@@ -74,12 +85,14 @@ class SpatiotemporalCO2:
         self.rnn_dropout = 0.05
         self.up_interp   = 'nearest'
 
-        self.optimizer   = AdamW(learning_rate=1e-3, weight_decay=1e-5)
+        self.learn_rate  = 1e-3
+        self.w_decay     = 1e-5
         self.criterion   = self.custom_loss
         self.L1L2_split  = 0.33
         self.ridge_alpha = 0.66
-        self.regular     = regularizers.l1(1e-6)
+        self.regular     = Float32L1(1e-6)
         self.leaky_slope = 0.25
+        self.jit_compile = True
         self.valid_split = 0.20
 
         self.num_epochs  = 100
@@ -102,113 +115,221 @@ class SpatiotemporalCO2:
 
     ################################### MODEL ARCHITECTURE ####################################
     def encoder_layer(self, inp, filt, kern=3, pad='same'):
-        _ = SeparableConv2D(filt, kern, padding=pad, activity_regularizer=self.regular)(inp)
-        _ = SqueezeExcite(filt)(_)
-        _ = GroupNormalization(groups=-1)(_)
+        # float32 L1 penalty on the fused block output, i.e. after SE gating and the pointwise projection
+        _ = FusedSepConvSE(filt, kern, padding=pad, jit_compile=self.jit_compile, activity_regularizer=self.regular)(inp)
+        _ = GroupNormalization(groups=-1, dtype='float32')(_)
         _ = PReLU()(_)
         _ = MaxPooling2D()(_)
         _ = SpatialDropout2D(self.rnn_dropout)(_)
         return _
     
-    def recurrent_decoder(self, z_input, residuals, previous_timestep=None):
-        dropout = self.rnn_dropout
+    def recurrent_decoder(self, z_input, residuals):
+        dropout, nt = self.rnn_dropout, len(self.t_samples)
+        def tile_time(z):
+            return tf.tile(tf.expand_dims(z,1), [1,nt,1,1,1])
         def recurrent_step(inp, filt, res, kern=3, pad='same', drop=dropout):
-            y = ConvLSTM2D(filt, kern, padding=pad)(inp)
-            y = GroupNormalization(groups=-1)(y)
+            y = ConvLSTM2D(filt, kern, padding=pad, return_sequences=True)(inp)
+            y = TimeDistributed(GroupNormalization(groups=-1, dtype='float32'))(y)
             y = LeakyReLU(self.leaky_slope)(y)
-            y = Conv2DTranspose(filt, kern, padding=pad, strides=2)(y)
-            y = SpatialDropout2D(drop)(y)
+            y = TimeDistributed(Conv2DTranspose(filt, kern, padding=pad, strides=2))(y)
+            y = TimeDistributed(SpatialDropout2D(drop))(y)
             y = Concatenate()([y, res])
-            y = Conv2D(filt, kern, padding=pad)(y)
+            y = TimeDistributed(Conv2D(filt, kern, padding=pad))(y)
             y = Activation('sigmoid')(y)
-            y = tf.expand_dims(y,1)
             return y
         def recurrent_last(inp, filt, kern=3, pad='same', drop=dropout):
-            y = ConvLSTM2D(filt, kern, padding=pad)(inp)
-            y = GroupNormalization(groups=-1)(y)
+            y = ConvLSTM2D(filt, kern, padding=pad, return_sequences=True)(inp)
+            y = TimeDistributed(GroupNormalization(groups=-1, dtype='float32'))(y)
             y = LeakyReLU(self.leaky_slope)(y)
-            y = Conv2DTranspose(filt, kern, padding=pad, strides=2)(y)
-            y = SpatialDropout2D(drop)(y)
-            y = Conv2D(self.y_channels, kern, padding=pad)(y)
-            y = Activation('sigmoid')(y)
-            y = tf.expand_dims(y, 1)
+            y = TimeDistributed(Conv2DTranspose(filt, kern, padding=pad, strides=2))(y)
+            y = TimeDistributed(SpatialDropout2D(drop))(y)
+            y = TimeDistributed(Conv2D(self.y_channels, kern, padding=pad))(y)
+            y = Activation('sigmoid', dtype='float32')(y)
             return y
-        _ = tf.expand_dims(z_input, 1)
-        _ = recurrent_step(_, self.rnn_filters[0], residuals[0])
-        _ = recurrent_step(_, self.rnn_filters[1], residuals[1])
+        _ = recurrent_step(tile_time(z_input), self.rnn_filters[0], tile_time(residuals[0]))
+        _ = recurrent_step(_, self.rnn_filters[1], tile_time(residuals[1]))
         _ = recurrent_last(_, self.rnn_filters[2])
-        if previous_timestep != None:
-            _ = Concatenate(axis=1)([previous_timestep, _])
         return _
     
-    def make_model(self):
+    def build_graph(self):
         inp = Input(self.X_train.shape[1:])
         z1  = self.encoder_layer(inp, self.cnn_filters[0])
         z2  = self.encoder_layer(z1,  self.cnn_filters[1])
         z3  = self.encoder_layer(z2,  self.cnn_filters[2])
-        t0  = self.recurrent_decoder(z3, [z2,z1])
-        t1  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t0)
-        t2  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t1)
-        t3  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t2)
-        t4  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t3)
-        t5  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t4)
-        t6  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t5)
-        t7  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t6)
-        t8  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t7)
-        t9  = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t8)
-        t10 = self.recurrent_decoder(z3, [z2,z1], previous_timestep=t9)
-        self.latent1 = Model(inp, z1, name='enc_layer_1'); self.latent1.compile('adam','mse',['mse'])
-        self.latent2 = Model(inp, z2, name='enc_layer_2'); self.latent2.compile('adam','mse',['mse'])
-        self.encoder = Model(inp, z3, name='encoder');     self.encoder.compile('adam','mse',['mse'])
-        self.model   = Model(inp, t10, name='CNN_RNN_Proxy')
+        out = self.recurrent_decoder(z3, [z2,z1])
+        return inp, (z1, z2, z3), out
+
+    def make_model(self):
+        self.strategy = tf.distribute.MirroredStrategy()
+        with self.strategy.scope():
+            inp, (z1, z2, z3), out = self.build_graph()
+            self.encoder       = Model(inp, z3, name='encoder')
+            self.encoder_stack = Model(inp, [z1,z2,z3], name='enc_stack')
+            self.model   = Model(inp, out, name='CNN_RNN_Proxy')
+            self.optimizer = mixed_precision.LossScaleOptimizer(AdamW(learning_rate=self.learn_rate, weight_decay=self.w_decay))
+            self.model.compile(optimizer=self.optimizer, loss=self.criterion, metrics=['mse'], jit_compile=self.jit_compile)
         if self.verbose != 0:
             print('# Parameters: {:,}'.format(self.model.count_params()))
         if self.return_data:
             return self.model
 
+    def custom_loss(self, true, pred):
+        true, pred = tf.cast(true, tf.float32), tf.cast(pred, tf.float32)
+        mse_loss   = tf.reduce_mean(tf.square(true - pred))
+        mae_loss   = tf.reduce_mean(tf.abs(true - pred))
+        ssim_loss  = 1.0 - tf.reduce_mean(tf.image.ssim(true, pred, max_val=1.0))
+        pixel_loss = self.L1L2_split * mse_loss + (1 - self.L1L2_split) * mae_loss
+        return self.ridge_alpha * pixel_loss + (1 - self.ridge_alpha) * ssim_loss
+
+    ######################################### TRAINING ########################################
+    def training(self):
+        n_valid  = int(self.valid_split * self.X_train.shape[0])
+        train_ds = self.build_dataset(self.X_train[n_valid:], self.y_train[n_valid:])
+        valid_ds = self.build_dataset(self.X_train[:n_valid], self.y_train[:n_valid], augment=False, shuffle=False)
+        lr_sched = ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=self.lr_decay)
+        start = time()
+        self.fit = self.model.fit(train_ds, validation_data=valid_ds, epochs=self.num_epochs,
+                                  callbacks=[lr_sched], verbose=self.verbose)
+        print('Training Time: {:.2f} minutes'.format((time()-start)/60))
+        if self.save_model == True:
+            self.model.save_weights('CNN_RNN_Proxy.weights.h5')
+
+    def float32_model(self):
+        # rebuild the proxy under a float32 policy without XLA so TFLite sees builtin-friendly ops
+        policy, jit = mixed_precision.global_policy(), self.jit_compile
+        mixed_precision.set_global_policy('float32'); self.jit_compile = False
+        try:
+            inp, _, out = self.build_graph()
+            model = Model(inp, out, name='CNN_RNN_Proxy_fp32')
+        finally:
+            mixed_precision.set_global_policy(policy); self.jit_compile = jit
+        model.set_weights(self.model.get_weights())
+        return model
+
+    def quantize_model(self, filename=None, int8=False, n_calibration=100, n_check=8):
+        # convert with a static batch dimension; a dynamic one breaks BROADCAST_TO in the TFLite graph
+        filename, model = self.tflite_file if filename is None else filename, self.float32_model()
+        fn = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+            tf.TensorSpec((self.batch_size,) + tuple(model.input_shape[1:]), tf.float32))
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([fn], model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        if int8 == True:
+            # int8 where calibration allows, float fallback for the rest (e.g., ConvLSTM)
+            xc = self.X_train[:n_calibration]
+            converter.representative_dataset = lambda: ([self._pad_batch(xc[i:i+self.batch_size], self.batch_size)]
+                                                        for i in range(0, xc.shape[0], self.batch_size))
+        else:
+            converter.target_spec.supported_types = [tf.float16]
+        tflite_model = converter.convert()
+        with open(filename, 'wb') as f:
+            f.write(tflite_model)
+        self.tflite_file = filename
+        print('Quantized model saved to {} ({:.2f} MB)'.format(filename, os.path.getsize(filename)/1e6))
+        if self.verbose != 0:
+            tf.lite.experimental.Analyzer.analyze(model_content=tflite_model) #op breakdown (builtin vs Flex)
+        xc = self.X_test[:n_check]
+        true, pred = self.model.predict(xc, batch_size=self.batch_size), self.predict_quantized(xc, filename)
+        print('TFLite vs Keras ({} samples) - MAE: {:.2e} | Max Abs Err: {:.2e}'.format(xc.shape[0], np.abs(true-pred).mean(), np.abs(true-pred).max()))
+
+    def _pad_batch(self, xb, batch_size, dtype=np.float32):
+        # zero-pad a short batch up to the static batch size of the TFLite graph
+        xb = np.asarray(xb, dtype=dtype)
+        if xb.shape[0] == batch_size:
+            return xb
+        return np.concatenate([xb, np.zeros((batch_size - xb.shape[0],) + xb.shape[1:], dtype=dtype)], axis=0)
+
+    def predict_quantized(self, X, filename=None):
+        interpreter = tf.lite.Interpreter(model_path=self.tflite_file if filename is None else filename)
+        interpreter.allocate_tensors()
+        inp, out = interpreter.get_input_details()[0], interpreter.get_output_details()[0]
+        batch_size = int(inp['shape'][0])
+        preds = []
+        for i in range(0, X.shape[0], batch_size):
+            xb = X[i:i+batch_size]
+            interpreter.set_tensor(inp['index'], self._pad_batch(xb, batch_size, inp['dtype']))
+            interpreter.invoke()
+            preds.append(interpreter.get_tensor(out['index'])[:xb.shape[0]])
+        return np.concatenate(preds, axis=0)
+
     ####################################### DATA LOADING ######################################
+    def _consolidate(self, x_shape, y_shape):
+        print('... Consolidating per-sample files ...')
+        x_tmp, y_tmp = self.x_all_file + '.tmp', self.y_all_file + '.tmp'
+        X_all = np.lib.format.open_memmap(x_tmp, mode='w+', dtype=np.float32, shape=x_shape)
+        y_all = np.lib.format.open_memmap(y_tmp, mode='w+', dtype=np.float32, shape=y_shape)
+        # write each sample directly in channels-last layout
+        def _load_one(i):
+            X_all[i] = np.moveaxis(np.load(self.input_features_dir + '/X_data_{}.npy'.format(i), mmap_mode='r'), 0, -1)
+            y_all[i] = np.moveaxis(np.load(self.output_targets_dir + '/y_data_{}.npy'.format(i), mmap_mode='r'), 1, -1)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as ex:
+            list(ex.map(_load_one, range(self.n_samples)))
+        X_all.flush(); y_all.flush()
+        del X_all, y_all
+        os.replace(x_tmp, self.x_all_file)
+        os.replace(y_tmp, self.y_all_file)
+
     def load_data(self):
         print('... Loading Full Dataset ...')
-        X_data = np.zeros((self.n_samples, self.x_channels, self.dim, self.dim))
-        y_data = np.zeros((self.n_samples, self.timesteps, self.y_channels, self.dim, self.dim))
-        for i in range(self.n_samples):
-            X_data[i] = np.load(self.input_features_dir + '/X_data_{}.npy'.format(i))
-            y_data[i] = np.load(self.output_targets_dir + '/y_data_{}.npy'.format(i))
-        self.X_data, self.y_data = np.moveaxis(X_data, 1, -1), np.moveaxis(y_data, 2, -1)
+        x_shape = (self.n_samples, self.dim, self.dim, self.x_channels)
+        y_shape = (self.n_samples, self.timesteps, self.dim, self.dim, self.y_channels)
+        stale = True
+        if os.path.exists(self.x_all_file) and os.path.exists(self.y_all_file):
+            self.X_data = np.load(self.x_all_file, mmap_mode='r')
+            self.y_data = np.load(self.y_all_file, mmap_mode='r')
+            stale = (self.X_data.shape != x_shape) or (self.y_data.shape != y_shape)
+        if stale:
+            self.X_data, self.y_data = None, None #release any stale memmaps before overwriting
+            self._consolidate(x_shape, y_shape)
+            self.X_data = np.load(self.x_all_file, mmap_mode='r')
+            self.y_data = np.load(self.y_all_file, mmap_mode='r')
         print('X: {} | y: {}'.format(self.X_data.shape, self.y_data.shape))
     
     def apply_noise(self, image_array, noise_type='gaussian', var=1e-6):
+        if (noise_type=='gaussian' or noise_type=='speckle'):
+            x = image_array[...,:-1]
+            noisy = np.random.default_rng().standard_normal(x.shape, dtype=np.float32)
+            noisy *= np.sqrt(var)
+            if noise_type=='speckle':
+                noisy *= x
+            noisy += x
+            np.clip(noisy, 0, 1, out=noisy)
+            return np.concatenate([noisy.astype(image_array.dtype, copy=False), image_array[...,-1:]], axis=-1) #keep Wells channel same
+        if noise_type in ('s&p', 'salt', 'pepper') and njit is not None:
+            salt_prob = {'s&p':0.5, 'salt':1.0, 'pepper':0.0}[noise_type]
+            noisy = _saltpepper_noise(image_array[...,:-1], 0.05, salt_prob)
+            return np.concatenate([noisy, image_array[...,-1:]], axis=-1) #keep Wells channel same
+        if noise_type == 'poisson' and njit is not None:
+            noisy = _poisson_noise(image_array[...,:-1])
+            return np.concatenate([noisy, image_array[...,-1:]], axis=-1) #keep Wells channel same
         noisy_array = np.zeros_like(image_array)
         for i in range(image_array.shape[0]):
             for c in range(image_array.shape[-1]-1):
-                if (noise_type=='gaussian' or noise_type=='speckle'):
-                    noisy_array[i,:,:,c] = random_noise(image_array[i,:,:,c], mode=noise_type, var=var)                    
-                else:
-                    noisy_array[i,:,:,c] = random_noise(image_array[i,:,:,c], mode=noise_type)
-            noisy_array[...,-1] = image_array[...,-1] #keep Wells channel same
+                noisy_array[i,:,:,c] = random_noise(image_array[i,:,:,c], mode=noise_type)
+        noisy_array[...,-1] = image_array[...,-1] #keep Wells channel same
         return noisy_array
         
+    def minmax_normalize(self, arr):
+        axes = tuple(range(arr.ndim-1))
+        mn, mx = arr.min(axis=axes, keepdims=True), arr.max(axis=axes, keepdims=True)
+        np.subtract(arr, mn, out=arr)
+        np.divide(arr, np.where(mx>mn, mx-mn, 1), out=arr)
+        return mn, mx
+
     def process_data(self, n_subsample=None, augment=True, rotations=3, add_noise=False):
-        # data augmentation
-        if augment==True:
-            xrot = np.rot90(self.X_data, k=rotations, axes=(1,2))
-            yrot = np.rot90(self.y_data, k=rotations, axes=(2,3))
-            x = np.concatenate([self.X_data, xrot], axis=0)
-            y = np.concatenate([self.y_data, yrot], axis=0)
-            print('Data Augmentation Done!    - n_samples={:,}'.format(x.shape[0]))
-        else:
-            x = self.X_data
-            y = self.y_data
-        # feature processing
-        num, height, width, channels = x.shape
-        xn = MinMaxScaler().fit_transform(x.reshape(num*height*width, channels)).reshape(x.shape)
+        # data augmentation (rotated copies are generated on-the-fly by build_dataset)
+        self.augment, self.rotations = augment, rotations
+        x = np.array(self.X_data, dtype=np.float32)
+        y = np.array(self.y_data, dtype=np.float32)
+        # feature processing (per-channel min-max, in place)
+        self._x_min, self._x_max = self.minmax_normalize(x)
         if add_noise == True:
-            self.X_norm = self.apply_noise(xn)
+            self.X_norm = self.apply_noise(x)
         else:
-            self.X_norm = xn
+            self.X_norm = x
         # target processing
-        num, tsteps, height, width, channels = y.shape
-        self.y_norm = MinMaxScaler().fit_transform(y.reshape(num*tsteps, -1)).reshape(y.shape)
+        self._y_min, self._y_max = self.minmax_normalize(y)
+        self.y_norm = y
         print('MinMax Normalization Done! - [{}, {}]'.format(self.X_norm.min(), self.X_norm.max()))
         # train-test split and subsampling
         ts = np.array(self.t_samples); ts[1:]-=1
@@ -219,12 +340,51 @@ class SpatiotemporalCO2:
         else:
             self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(self.X_norm, self.y_norm[:,ts], test_size=self.test_size)
         if self.save_model == True:
-            np.savez('xy_data.npz', X_train=self.X_train, X_test=self.X_test, y_train=self.y_train, y_test=self.y_test)
+            self.save_xy_train_test()
         print('Train - X: {} | y: {}'.format(self.X_train.shape, self.y_train.shape))
         print('Test  - X: {}  | y: {}'.format(self.X_test.shape, self.y_test.shape))
         
-    def load_preprocessed_xy_train_test(self, filename):
-        loaded_data = np.load(filename)
+    def build_dataset(self, X, y, augment=None, shuffle=True):
+        # shuffle sample indices (rotated copies are indices >= n), then gather each batch
+        augment, n, k = self.augment if augment is None else augment, X.shape[0], self.rotations
+        def gather(idx):
+            return np.array(X[idx % n], dtype=np.float32), np.array(y[idx % n], dtype=np.float32)
+        def fetch(idx):
+            idx = tf.sort(idx)
+            xb, yb = tf.numpy_function(gather, [idx], [tf.float32, tf.float32])
+            xb.set_shape((None,) + X.shape[1:]); yb.set_shape((None,) + y.shape[1:])
+            if augment==True:
+                # idx is sorted, so the rotated copies (idx >= n) are the tail of the batch
+                n_orig = tf.reduce_sum(tf.cast(idx < n, tf.int32))
+                xb = tf.concat([xb[:n_orig], tf.experimental.numpy.rot90(xb[n_orig:], k, axes=(1,2))], axis=0)
+                yb = tf.concat([yb[:n_orig], tf.experimental.numpy.rot90(yb[n_orig:], k, axes=(2,3))], axis=0)
+            return xb, yb
+        n_total = 2*n if augment==True else n
+        ds = tf.data.Dataset.range(n_total)
+        if shuffle==True:
+            ds = ds.shuffle(n_total, reshuffle_each_iteration=True)
+        ds = ds.batch(self.batch_size * self.strategy.num_replicas_in_sync)
+        return ds.map(fetch, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+    def save_xy_train_test(self, folder='xy_data'):
+        os.makedirs(folder, exist_ok=True)
+        for name in ['X_train', 'X_test', 'y_train', 'y_test']:
+            np.save('{}/{}.npy'.format(folder, name), getattr(self, name))
+
+    def load_preprocessed_xy_train_test(self, filename='xy_data'):
+        names = ['X_train', 'X_test', 'y_train', 'y_test']
+        if not os.path.isdir(filename):
+            # legacy .npz cannot be memory-mapped: unpack it once into <stem>_npz/, one array at a time
+            # re-extract every array if any is missing or older than the archive, so arrays never mix
+            folder, mtime = os.path.splitext(filename)[0] + '_npz', os.path.getmtime(filename)
+            files = ['{}/{}.npy'.format(folder, name) for name in names]
+            if any(not os.path.exists(f) or os.path.getmtime(f) < mtime for f in files):
+                with np.load(filename) as npz:
+                    os.makedirs(folder, exist_ok=True)
+                    for name, f in zip(names, files):
+                        np.save(f, npz[name])
+            filename = folder
+        loaded_data = {name: np.load('{}/{}.npy'.format(filename, name), mmap_mode='r') for name in names}
         self.X_train, self.X_test = loaded_data['X_train'], loaded_data['X_test']
         self.y_train, self.y_test = loaded_data['y_train'], loaded_data['y_test']
         return (self.X_train, self.X_test), (self.y_train, self.y_test)
@@ -322,7 +482,7 @@ class SpatiotemporalCO2:
             data = self.X_test
         else:
             print('Please select "train" or "test" to display')
-        self.z = self.encoder.predict(data)
+        self.z = self.encoder.predict(data, batch_size=self.batch_size)
         z_mean = self.z.mean(-1)
         print('Latent shape: {}'.format(self.z.shape))
         if self.return_data:
@@ -331,12 +491,14 @@ class SpatiotemporalCO2:
         if plot == True:
             if jmult == None:
                 jmult = self.z.shape[-1]//ncols
+            ps = [i*imult for i in range(nrows)]
+            wlocs_map = {p: np.argwhere(data[p,:,:,-1]!=0) for p in ps}
             _, axs = plt.subplots(nrows, ncols+2, figsize=figsize)
             for i in range(nrows):
+                p = ps[i]
+                poro, facies, wlocs = data[p,:,:,0], data[p,:,:,2], wlocs_map[p]
                 for j in range(ncols):
-                    p, q = i*imult, j*jmult
-                    poro, facies = data[p,:,:,0], data[p,:,:,2]
-                    w = data[p,:,:,-1]; wlocs = np.argwhere(w!=0)
+                    q = j*jmult
                     axs[i,j].imshow(self.z[p,:,:,q], cmap=self.latent_cmap[0])
                     axs[i,j].set(xticks=[], yticks=[])
                     axs[i,0].set_ylabel('R {}'.format(p), weight='bold')
@@ -352,28 +514,23 @@ class SpatiotemporalCO2:
             plt.show()
 
     def feature_map_animation(self, nrows=4, ncols=8, imult=200, jmult=1, figsize=(15,5), blit=False, interval=900):
-        z1 = self.latent1.predict(self.X_train)
-        z2 = self.latent2.predict(self.X_train)
-        z3 = self.encoder.predict(self.X_train)
+        z1, z2, z3 = self.encoder_stack.predict(self.X_train, batch_size=self.batch_size)
         z = {0:z1, 1:z2, 2:z3}
         print('z1: {} | z2: {} | z3: {}'.format(z1.shape, z2.shape, z3.shape))
         fig, axs = plt.subplots(nrows, ncols, figsize=figsize)
+        ims = {}
         for i in range(nrows):
             for j in range(ncols):
                 p, q = i*imult, j*jmult
-                axs[i,j].imshow(z[0][p,:,:,q], cmap=self.latent_cmap[0])
+                ims[(i,j)] = axs[i,j].imshow(z[0][p,:,:,q], cmap=self.latent_cmap[0])
                 axs[i,j].set(xticks=[], yticks=[])
                 axs[0,j].set(title='FM {}'.format(q))
             axs[i,0].set_ylabel('R {}'.format(p))
         def animate(k):
-            for i in range(nrows):
-                for j in range(ncols):
-                    p, q = i*imult, j*jmult
-                    axs[i,j].imshow(z[k][p,:,:,q], cmap=self.latent_cmap[0])
-                    axs[i,j].set(xticks=[], yticks=[])
-                    axs[0,j].set(title='FM {}'.format(q))
-                axs[i,0].set_ylabel('R {}'.format(p))
-            return axs
+            for (i,j), im in ims.items():
+                im.set_data(z[k][i*imult,:,:,j*jmult])
+                im.autoscale()
+            return list(ims.values())
         ani = FuncAnimation(fig, animate, frames=len(z), blit=blit, interval=interval)
         ani.save('figures/feature_maps_animation.gif')
         plt.show()
@@ -381,12 +538,8 @@ class SpatiotemporalCO2:
     
     def cumulative_co2(self, threshold=0.02, alpha=0.7, figsize=(12,6)):
         def compare_cumulative_co2(true, pred, thresh=threshold):
-            true_co2, pred_co2 = {}, {}
-            for i in range(true.shape[0]):
-                true_co2[i] = true[i][np.where(true[i]>thresh)].sum()
-                pred_co2[i] = pred[i][np.where(pred[i]>thresh)].sum()
-            true_co2 = np.array(list(true_co2.values()))
-            pred_co2 = np.array(list(pred_co2.values()))
+            true_co2 = np.where(true>thresh, true, 0).sum(axis=tuple(range(1, true.ndim)))
+            pred_co2 = np.where(pred>thresh, pred, 0).sum(axis=tuple(range(1, pred.ndim)))
             return true_co2, pred_co2
         true_co2_train,  pred_co2_train  = compare_cumulative_co2(self.y_train, self.y_train_pred)
         true_co2_test,   pred_co2_test   = compare_cumulative_co2(self.y_test,  self.y_test_pred) 
@@ -413,25 +566,73 @@ class SpatiotemporalCO2:
         return None
 
 ############################################ UTILITIES ############################################
-class SqueezeExcite(Layer):
-    def __init__(self, ratio=4, **kwargs):
-        super(SqueezeExcite, self).__init__(**kwargs)
-        self.ratio = ratio
+def _saltpepper_noise(x, amount, salt_prob):
+    out = x.copy()
+    n, h, w, c = x.shape
+    for i in prange(n):
+        for j in range(h):
+            for k in range(w):
+                for l in range(c):
+                    if np.random.random() < amount:
+                        out[i,j,k,l] = 1.0 if np.random.random() < salt_prob else 0.0
+    return out
+
+def _poisson_noise(x):
+    out = np.empty_like(x)
+    n, h, w, c = x.shape
+    for i in prange(n):
+        for l in range(c):
+            vals = 2.0 ** np.ceil(np.log2(len(np.unique(x[i,:,:,l].copy()))))
+            for j in range(h):
+                for k in range(w):
+                    out[i,j,k,l] = min(max(np.random.poisson(x[i,j,k,l] * vals) / vals, 0.0), 1.0)
+    return out
+
+if njit is not None:
+    _saltpepper_noise = njit(parallel=True)(_saltpepper_noise)
+    _poisson_noise    = njit(parallel=True)(_poisson_noise)
+
+class Float32L1(regularizers.Regularizer):
+    # L1 activity penalty summed in float32; a float16 sum over a full feature map overflows to inf
+    def __init__(self, l1=0.01):
+        self.l1 = l1
+    def __call__(self, x):
+        return self.l1 * tf.reduce_sum(tf.abs(tf.cast(x, tf.float32)))
+    def get_config(self):
+        return {'l1': float(self.l1)}
+
+class FusedSepConvSE(Layer):
+    def __init__(self, filters, kernel_size=3, se_units=1, padding='same', jit_compile=True, **kwargs):
+        super(FusedSepConvSE, self).__init__(**kwargs)
+        self.filters     = filters
+        self.kernel_size = kernel_size
+        self.se_units    = se_units
+        self.padding     = padding.upper()
+        self.jit_compile = jit_compile
     def build(self, input_shape):
-        channels = input_shape[-1]
-        self.squeeze = GlobalAveragePooling2D()
-        self.excite1 = Dense(channels // self.ratio, activation='relu')
-        self.excite2 = Dense(channels, activation='sigmoid')
-        super(SqueezeExcite, self).build(input_shape)
+        channels, hidden, k = input_shape[-1], self.se_units, self.kernel_size
+        self.dw = self.add_weight(name='depthwise_kernel', shape=(k, k, channels, 1),            initializer='glorot_uniform')
+        self.w1 = self.add_weight(name='excite1_kernel',   shape=(channels, hidden),             initializer='glorot_uniform')
+        self.b1 = self.add_weight(name='excite1_bias',     shape=(hidden,),                      initializer='zeros')
+        self.w2 = self.add_weight(name='excite2_kernel',   shape=(hidden, channels),             initializer='glorot_uniform')
+        self.b2 = self.add_weight(name='excite2_bias',     shape=(channels,),                    initializer='zeros')
+        self.pw = self.add_weight(name='pointwise_kernel', shape=(1, 1, channels, self.filters), initializer='glorot_uniform')
+        self.b  = self.add_weight(name='bias',             shape=(self.filters,),                initializer='zeros')
+        self._fused = tf.function(self._fused_impl, jit_compile=True) if self.jit_compile else self._fused_impl
+        super(FusedSepConvSE, self).build(input_shape)
+    def _fused_impl(self, inputs):
+        dw, w1, b1, w2, b2, pw, b = [tf.cast(v, inputs.dtype) for v in (self.dw, self.w1, self.b1, self.w2, self.b2, self.pw, self.b)]
+        z = tf.nn.depthwise_conv2d(inputs, dw, strides=[1,1,1,1], padding=self.padding)
+        se_tensor = tf.reduce_mean(z, [1,2])
+        se_tensor = tf.nn.relu(tf.matmul(se_tensor, w1) + b1)
+        se_tensor = tf.sigmoid(tf.matmul(se_tensor, w2) + b2)
+        z = z * (1 + se_tensor[:,None,None,:])
+        return tf.nn.conv2d(z, pw, strides=1, padding='VALID') + b
     def call(self, inputs):
-        se_tensor = self.squeeze(inputs)
-        se_tensor = self.excite1(se_tensor)
-        se_tensor = self.excite2(se_tensor)
-        se_tensor = Reshape((1, 1, se_tensor.shape[-1]))(se_tensor)
-        scaled_inputs = Multiply()([inputs, se_tensor])
-        return Add()([inputs, scaled_inputs])
+        return self._fused(inputs)
     def compute_output_shape(self, input_shape):
-        return input_shape
+        k = 1 if self.padding=='SAME' else self.kernel_size
+        return (input_shape[0], input_shape[1]-k+1, input_shape[2]-k+1, self.filters)
     
 ############################################## MAIN ###############################################
 if __name__ == '__main__':